@@ -1,9 +1,16 @@
 """SMTP email alert sender for anomaly notifications."""
+import asyncio
 import logging
+import quopri
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from typing import TYPE_CHECKING
+import threading
+from collections import deque
+from contextlib import contextmanager
+from email.header import Header
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterator
+
+from jinja2 import Environment
 
 from app.config import settings
 
@@ -14,36 +21,129 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
-def send_anomaly_alert(tenant: "Tenant", anomalies: list["Anomaly"]) -> None:
-    """Send SMTP email listing high-confidence anomalies to the tenant's alert email."""
-    if not settings.smtp_user or not tenant.alert_email:
-        return
-    if not anomalies:
-        return
+class _PooledSMTP(smtplib.SMTP):
+    """SMTP connection that counts messages sent so the pool can recycle it."""
 
-    n = len(anomalies)
-    subject = f"\u26a0\ufe0f {n} anomal{'y' if n == 1 else 'ies'} found in your accounts payable"
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages_sent = 0
 
-    rows_html = ""
-    for a in anomalies:
-        severity_color = {"high": "#f85149", "medium": "#d29922", "low": "#3fb950"}.get(a.severity, "#8b949e")
-        amount_str = f"${a.amount:,.2f}" if a.amount is not None else "-"
-        confidence_str = f"{a.confidence_score * 100:.0f}%" if a.confidence_score is not None else "-"
-        rows_html += f"""
-        <tr>
-          <td style="padding:8px;border-bottom:1px solid #30363d;">{a.anomaly_type.replace('_', ' ').title()}</td>
-          <td style="padding:8px;border-bottom:1px solid #30363d;color:{severity_color};">{a.severity.upper()}</td>
-          <td style="padding:8px;border-bottom:1px solid #30363d;">{amount_str}</td>
-          <td style="padding:8px;border-bottom:1px solid #30363d;">{confidence_str}</td>
-          <td style="padding:8px;border-bottom:1px solid #30363d;">{a.description or '-'}</td>
-        </tr>"""
-
-    html = f"""
+    def sendmail(self, *args, **kwargs):
+        result = super().sendmail(*args, **kwargs)
+        self.messages_sent += 1
+        return result
+
+
+def _quit_quietly(server: smtplib.SMTP) -> None:
+    """Close a connection without raising if the server already dropped it."""
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+class SMTPConnectionPool:
+    """
+    Reusable authenticated SMTP connections for one (host, port, user).
+    Connections are opened lazily, health-checked with NOOP on checkout, and
+    recycled after max_messages so we stay under provider per-session limits.
+    """
+
+    def __init__(self, host: str, port: int, user: str, password: str, max_messages: int = 100):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.max_messages = max_messages
+        self._idle: list[_PooledSMTP] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> _PooledSMTP:
+        server = _PooledSMTP(self.host, self.port, timeout=30)
+        server.ehlo()
+        server.starttls()
+        server.login(self.user, self.password)
+        return server
+
+    def get_connection(self) -> _PooledSMTP:
+        """Check out a live connection, reconnecting if idle ones were dropped by the server."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server = self._idle.pop()
+            try:
+                server.noop()
+                return server
+            except (smtplib.SMTPException, OSError):
+                _quit_quietly(server)
+        return self._connect()
+
+    def return_connection(self, server: _PooledSMTP) -> None:
+        """Return a connection to the pool, or close it once it hit the message cap."""
+        if server.messages_sent >= self.max_messages:
+            _quit_quietly(server)
+            return
+        with self._lock:
+            self._idle.append(server)
+
+    @contextmanager
+    def connection(self) -> Iterator[_PooledSMTP]:
+        server = self.get_connection()
+        try:
+            yield server
+        except Exception:
+            # Connection state is unknown after a failure — don't hand it out again
+            _quit_quietly(server)
+            raise
+        self.return_connection(server)
+
+    def close_all(self) -> None:
+        """QUIT every idle connection (called on shutdown)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server in idle:
+            _quit_quietly(server)
+
+
+# Module-level pools so connections are shared across requests
+_pools: dict[tuple[str, int, str], SMTPConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool() -> SMTPConnectionPool:
+    key = (settings.smtp_host, settings.smtp_port, settings.smtp_user)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SMTPConnectionPool(
+                settings.smtp_host,
+                settings.smtp_port,
+                settings.smtp_user,
+                settings.smtp_password,
+                max_messages=settings.smtp_max_messages_per_connection,
+            )
+            _pools[key] = pool
+    return pool
+
+
+def close_smtp_pools() -> None:
+    """Close all pooled SMTP connections."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
+SEVERITY_COLORS = {"high": "#f85149", "medium": "#d29922", "low": "#3fb950"}
+
+# Compiled once at import; autoescape covers tenant names and anomaly descriptions
+_ALERT_TEMPLATE = Environment(autoescape=True).from_string("""
     <html>
     <body style="font-family:sans-serif;background:#0d1117;color:#e6edf3;padding:24px;">
       <h2 style="color:#58a6ff;">A/P Anomaly Detector Alert</h2>
-      <p>Hello {tenant.name},</p>
-      <p>{n} anomal{'y' if n == 1 else 'ies'} requiring your attention {'was' if n == 1 else 'were'} detected in your accounts payable:</p>
+      <p>Hello {{ tenant.name }},</p>
+      <p>{{ n }} anomal{{ 'y' if n == 1 else 'ies' }} requiring your attention {{ 'was' if n == 1 else 'were' }} detected in your accounts payable:</p>
       <table style="width:100%;border-collapse:collapse;margin-top:16px;">
         <thead>
           <tr style="background:#161b22;">
@@ -54,26 +154,136 @@ def send_anomaly_alert(tenant: "Tenant", anomalies: list["Anomaly"]) -> None:
             <th style="padding:8px;text-align:left;color:#8b949e;font-size:12px;">DESCRIPTION</th>
           </tr>
         </thead>
-        <tbody>{rows_html}</tbody>
+        <tbody>{% for a in anomalies %}
+        <tr>
+          <td style="padding:8px;border-bottom:1px solid #30363d;">{{ a.anomaly_type.replace('_', ' ').title() }}</td>
+          <td style="padding:8px;border-bottom:1px solid #30363d;color:{{ colors.get(a.severity, '#8b949e') }};">{{ a.severity.upper() }}</td>
+          <td style="padding:8px;border-bottom:1px solid #30363d;">{{ '${:,.2f}'.format(a.amount) if a.amount is not none else '-' }}</td>
+          <td style="padding:8px;border-bottom:1px solid #30363d;">{{ '{:.0f}%'.format(a.confidence_score * 100) if a.confidence_score is not none else '-' }}</td>
+          <td style="padding:8px;border-bottom:1px solid #30363d;">{{ a.description or '-' }}</td>
+        </tr>{% endfor %}</tbody>
       </table>
       <p style="margin-top:24px;color:#8b949e;font-size:12px;">
         Log in to your A/P Anomaly Detector dashboard to review and dismiss these alerts.
       </p>
     </body>
-    </html>"""
+    </html>""")
 
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = subject
-    msg["From"] = settings.alert_from_email or settings.smtp_user
-    msg["To"] = tenant.alert_email
-    msg.attach(MIMEText(html, "html"))
 
-    try:
-        with smtplib.SMTP(settings.smtp_host, settings.smtp_port) as server:
-            server.ehlo()
-            server.starttls()
-            server.login(settings.smtp_user, settings.smtp_password)
-            server.sendmail(msg["From"], [tenant.alert_email], msg.as_string())
-        logger.info("Alert email sent to %s for tenant %s (%d anomalies)", tenant.alert_email, tenant.id, n)
-    except Exception as exc:
-        logger.error("Failed to send alert email for tenant %s: %s", tenant.id, exc)
+_HTML_PART_HEADERS = (
+    "MIME-Version: 1.0\r\n"
+    "Content-Type: text/html; charset=utf-8\r\n"
+    "Content-Transfer-Encoding: quoted-printable\r\n"
+    "\r\n"
+)
+
+
+@lru_cache(maxsize=128)
+def _subject_header(n: int) -> str:
+    """RFC 2047-encoded subject (it contains an emoji); depends only on the anomaly count."""
+    subject = f"\u26a0\ufe0f {n} anomal{'y' if n == 1 else 'ies'} found in your accounts payable"
+    return Header(subject, "utf-8").encode()
+
+
+def _is_plain_address(addr: str) -> bool:
+    # Raw header values: must be ASCII (smtplib sends str messages as ASCII) with no header injection
+    return addr.isascii() and "\r" not in addr and "\n" not in addr
+
+
+# Rendered alerts waiting for the next flush:
+# (tenant_id, from_addr, to_addr, message, anomaly_count, failed_attempts)
+_pending: deque[tuple[int, str, str, str, int, int]] = deque()
+# One flush at a time, e.g. the shutdown flush waits for an interval flush still running in its thread
+_flush_lock = threading.Lock()
+# Flushes an alert is tried in before it's dropped, when the SMTP session itself fails
+MAX_SEND_ATTEMPTS = 3
+
+
+def queue_anomaly_alert(tenant: "Tenant", anomalies: list["Anomaly"]) -> None:
+    """Render the alert email for a tenant and queue it for the next flush."""
+    if not settings.smtp_user or not tenant.alert_email:
+        return
+    if not anomalies:
+        return
+
+    from_addr = settings.alert_from_email or settings.smtp_user
+    to_addr = tenant.alert_email
+    if not _is_plain_address(from_addr) or not _is_plain_address(to_addr):
+        logger.error("Skipping alert email for tenant %s: unsupported address", tenant.id)
+        return
+
+    n = len(anomalies)
+    html = _ALERT_TEMPLATE.render(tenant=tenant, anomalies=anomalies, n=n, colors=SEVERITY_COLORS)
+
+    # Single text/html part, so the message is assembled directly rather than via email.mime objects
+    message = (
+        f"Subject: {_subject_header(n)}\r\n"
+        f"From: {from_addr}\r\n"
+        f"To: {to_addr}\r\n"
+        f"{_HTML_PART_HEADERS}"
+        f"{quopri.encodestring(html.encode('utf-8')).decode('ascii')}"
+    )
+    _pending.append((tenant.id, from_addr, to_addr, message, n, 0))
+
+
+def flush_pending_alerts() -> int:
+    """
+    Send every queued alert over pooled SMTP sessions — one handshake for the whole
+    batch, with a fresh connection every max_messages. Returns the number sent.
+    If a session fails, the unsent alerts go back on the queue for the next flush.
+    """
+    with _flush_lock:
+        batch = []
+        while True:
+            try:
+                batch.append(_pending.popleft())
+            except IndexError:
+                break
+        if not batch:
+            return 0
+
+        pool = get_pool()
+        sent = 0
+        start = 0
+        while start < len(batch):
+            chunk = batch[start:start + pool.max_messages]
+            handled = 0  # alerts in this chunk sent or rejected by the server
+            try:
+                with pool.connection() as server:
+                    # A reused connection has already sent some messages; only fill it up to the cap
+                    chunk = chunk[:pool.max_messages - server.messages_sent]
+                    for tenant_id, from_addr, to_addr, message, n, _ in chunk:
+                        try:
+                            server.sendmail(from_addr, [to_addr], message)
+                        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as exc:
+                            # Rejected message only — the session is still usable for the rest
+                            logger.error("Failed to send alert email for tenant %s: %s", tenant_id, exc)
+                            handled += 1
+                            continue
+                        handled += 1
+                        sent += 1
+                        logger.info("Alert email sent to %s for tenant %s (%d anomalies)", to_addr, tenant_id, n)
+            except Exception as exc:
+                # Connect/login failed or the session dropped: keep everything not yet handled
+                _requeue(batch[start + handled:], exc)
+                break
+            start += len(chunk)
+        return sent
+
+
+def _requeue(alerts: list[tuple[int, str, str, str, int, int]], exc: Exception) -> None:
+    """Put unsent alerts back at the front of the queue, dropping those out of attempts."""
+    retry = [(*alert[:5], alert[5] + 1) for alert in alerts if alert[5] + 1 < MAX_SEND_ATTEMPTS]
+    dropped = len(alerts) - len(retry)
+    logger.error(
+        "SMTP session failed (%s): %d alert emails requeued, %d dropped after %d attempts",
+        exc, len(retry), dropped, MAX_SEND_ATTEMPTS,
+    )
+    _pending.extendleft(reversed(retry))
+
+
+async def run_alert_flusher(interval_seconds: int) -> None:
+    """Flush queued alerts every interval_seconds until cancelled."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        await asyncio.to_thread(flush_pending_alerts)
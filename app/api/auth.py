@@ -1,14 +1,40 @@
 """API key authentication dependency."""
+import hashlib
+import hmac
+
 from fastapi import Header, HTTPException, Depends
 from sqlalchemy.orm import Session
 
+from app.cache import TTLCache
 from app.database import get_db
 from app.models import Tenant
 
+# sha256(api_key) -> tenant id, so repeat requests load the tenant by primary key
+_tenant_ids = TTLCache(maxsize=10_000, ttl_seconds=60)
+
+
+def _key_digest(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
 
 def get_tenant_by_key(x_api_key: str = Header(...), db: Session = Depends(get_db)) -> Tenant:
     """Validate X-API-Key header and return the matching tenant."""
+    digest = _key_digest(x_api_key)
+    tenant_id = _tenant_ids.get(digest)
+    if tenant_id is not None:
+        tenant = db.get(Tenant, tenant_id)
+        # Re-check the stored key: it may have been rotated by another worker since caching
+        if tenant and tenant.api_key and hmac.compare_digest(tenant.api_key.encode(), x_api_key.encode()):
+            return tenant
+        _tenant_ids.pop(digest)
+
     tenant = db.query(Tenant).filter(Tenant.api_key == x_api_key).first()
     if not tenant:
         raise HTTPException(status_code=401, detail="Invalid API key")
+    _tenant_ids.set(digest, tenant.id)
     return tenant
+
+
+def invalidate_api_key(api_key: str) -> None:
+    """Drop a key from the lookup cache (call when a key is rotated)."""
+    _tenant_ids.pop(_key_digest(api_key))
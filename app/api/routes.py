@@ -1,16 +1,20 @@
 """API routes for tenants, sync, detection, anomalies."""
+import base64
+import binascii
 import csv
 import io
 import logging
 import secrets
-from datetime import date
+from datetime import date, datetime
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Response
 from fastapi.responses import RedirectResponse, StreamingResponse
-from sqlalchemy import func, distinct
+from sqlalchemy import String, func, literal, select, tuple_, update
 from sqlalchemy.orm import Session
 
-from app.database import get_db
+from app.cache import TTLCache
+from app.database import SessionLocal, get_db
 from app.models import Tenant, Bill, Vendor, Anomaly
 from app.schemas import (
     TenantCreate,
@@ -21,16 +25,16 @@ from app.schemas import (
     AnomalyUpdate,
     ConnectQBOBody,
     QBOCallbackQuery,
-    SyncResult,
+    SyncJob,
     DetectionResult,
     DashboardStats,
 )
-from app.schemas import MAX_LEN_OAUTH_CODE, MAX_LEN_STATE, MAX_LEN_REALM_ID
-from app.api.auth import get_tenant_by_key
-from app.pipeline.sync import sync_tenant
+from app.schemas import MAX_LEN_OAUTH_CODE, MAX_LEN_STATE, MAX_LEN_REALM_ID, MAX_LEN_CURSOR
+from app.api.auth import get_tenant_by_key, invalidate_api_key
+from app.pipeline.jobs import enqueue_sync, get_job
 from app.detection.engine import run_detection
 from app.connectors.quickbooks import get_authorization_url, exchange_code_for_tokens
-from app.alerts.email import send_anomaly_alert
+from app.alerts.email import queue_anomaly_alert
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -39,6 +43,13 @@ logger = logging.getLogger(__name__)
 TenantIdPath = Path(..., gt=0, description="Tenant ID (positive integer)")
 AnomalyIdPath = Path(..., gt=0, description="Anomaly ID (positive integer)")
 
+# Dashboard stats per tenant; dropped by sync/detect, which change the counts
+_dashboard_cache = TTLCache(maxsize=10_000, ttl_seconds=15)
+
+# CSV export: rows fetched per DB round-trip, and bytes buffered before each chunk is sent
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_BYTES = 64 * 1024
+
 
 def get_qbo_callback_query(
     code: str = Query(..., min_length=1, max_length=MAX_LEN_OAUTH_CODE),
@@ -66,7 +77,12 @@ def qbo_callback(
 ):
     """Handle QuickBooks OAuth callback, store tokens, redirect to dashboard."""
     state = query.state
-    tenant_id = int(state.replace("tenant_", "")) if state and state.startswith("tenant_") else 1
+    tenant_id = 1
+    if state.startswith("tenant_"):
+        suffix = state[len("tenant_"):]
+        if not (suffix.isascii() and suffix.isdigit()):
+            raise HTTPException(400, "Invalid state parameter")
+        tenant_id = int(suffix)
     if tenant_id <= 0:
         raise HTTPException(400, "Invalid state parameter")
     token = exchange_code_for_tokens(query.code)
@@ -130,6 +146,7 @@ def rotate_api_key(
     if tenant.id != tenant_id:
         raise HTTPException(403, "Forbidden")
     new_key = secrets.token_hex(32)
+    invalidate_api_key(tenant.api_key)
     tenant.api_key = new_key
     db.commit()
     logger.info("API key rotated for tenant id=%s", tenant_id)
@@ -153,21 +170,33 @@ def connect_qbo(
     return {"status": "connected"}
 
 
-@router.post("/tenants/{tenant_id}/sync", response_model=SyncResult)
+@router.post("/tenants/{tenant_id}/sync", response_model=SyncJob, status_code=202)
 def sync(
     tenant_id: int = TenantIdPath,
     tenant: Tenant = Depends(get_tenant_by_key),
-    db: Session = Depends(get_db),
 ):
-    """Sync vendors, bills, payments from QuickBooks."""
+    """Queue a sync of vendors, bills, payments from QuickBooks; poll the returned job for the result."""
     if tenant.id != tenant_id:
         raise HTTPException(403, "Forbidden")
-    try:
-        counts = sync_tenant(tenant, db)
-        return SyncResult(**counts)
-    except Exception as e:
-        logger.error("Sync failed for tenant %s: %s", tenant_id, e)
-        raise HTTPException(500, str(e))
+    if not tenant.access_token or not tenant.accounting_realm_id:
+        raise HTTPException(400, "Tenant missing OAuth tokens or realm_id")
+    # Sync commits as it goes, so even a failed sync may have changed the counts
+    return enqueue_sync(tenant_id, on_finish=lambda: _dashboard_cache.pop(tenant_id))
+
+
+@router.get("/tenants/{tenant_id}/syncs/{job_id}", response_model=SyncJob)
+def get_sync(
+    tenant_id: int = TenantIdPath,
+    job_id: str = Path(..., pattern=r"^[0-9a-f]{32}$"),
+    tenant: Tenant = Depends(get_tenant_by_key),
+):
+    """Status of a queued sync job."""
+    if tenant.id != tenant_id:
+        raise HTTPException(403, "Forbidden")
+    job = get_job(job_id)
+    if job is None or job["tenant_id"] != tenant_id:
+        raise HTTPException(404, "Sync job not found")
+    return job
 
 
 @router.post("/tenants/{tenant_id}/detect", response_model=DetectionResult)
@@ -180,10 +209,10 @@ def detect(
     if tenant.id != tenant_id:
         raise HTTPException(403, "Forbidden")
     count = run_detection(tenant_id, db)
-    db.commit()
+    _dashboard_cache.pop(tenant_id)
     logger.info("Detection run for tenant %s: %d anomalies found", tenant_id, count)
 
-    # Send email alert if configured
+    # Queue email alert if configured — sent in the next batched SMTP flush, not on this request
     if settings_smtp_enabled() and tenant.alert_email and count > 0:
         alertable = (
             db.query(Anomaly)
@@ -197,7 +226,7 @@ def detect(
             .all()
         )
         if alertable:
-            send_anomaly_alert(tenant, alertable)
+            queue_anomaly_alert(tenant, alertable)
 
     return DetectionResult(anomalies_found=count)
 
@@ -209,6 +238,7 @@ def settings_smtp_enabled() -> bool:
 
 @router.get("/tenants/{tenant_id}/anomalies", response_model=list[AnomalyOut])
 def list_anomalies(
+    response: Response,
     tenant_id: int = TenantIdPath,
     status: str = Query(
         default="open",
@@ -217,36 +247,78 @@ def list_anomalies(
         description="Filter: open, acknowledged, dismissed, all",
     ),
     limit: int = Query(default=100, ge=1, le=500),
-    offset: int = Query(default=0, ge=0),
+    offset: int = Query(default=0, ge=0, description="Deprecated: use cursor"),
+    cursor: Optional[str] = Query(
+        default=None,
+        max_length=MAX_LEN_CURSOR,
+        description="Opaque X-Next-Cursor value from the previous page",
+    ),
     tenant: Tenant = Depends(get_tenant_by_key),
     db: Session = Depends(get_db),
 ):
-    """List anomalies for tenant with vendor name and bill number, newest first."""
+    """
+    List anomalies for tenant with vendor name and bill number, newest first.
+    Keyset-paginated: pass the X-Next-Cursor response header back as ?cursor=.
+    """
     if tenant.id != tenant_id:
         raise HTTPException(403, "Forbidden")
 
+    # Plain column rows (no ORM entity instantiation) — only what AnomalyOut needs
     q = (
-        db.query(Anomaly, Vendor.name.label("vendor_name"), Bill.bill_number.label("bill_number"))
+        select(
+            Anomaly.id,
+            Anomaly.bill_id,
+            Anomaly.anomaly_type,
+            Anomaly.severity,
+            Anomaly.amount,
+            Anomaly.confidence_score,
+            Anomaly.description,
+            Anomaly.should_alert,
+            Anomaly.status,
+            Anomaly.resolution_notes,
+            Anomaly.created_at,
+            Vendor.name.label("vendor_name"),
+            Bill.bill_number,
+        )
         .outerjoin(Bill, Anomaly.bill_id == Bill.id)
         .outerjoin(Vendor, Bill.vendor_id == Vendor.id)
-        .filter(Anomaly.tenant_id == tenant_id)
+        .where(Anomaly.tenant_id == tenant_id)
     )
 
     # Strict status filter (valid set only)
     if status not in ("open", "acknowledged", "dismissed", "all"):
         raise HTTPException(400, "status must be one of: open, acknowledged, dismissed, all")
     if status != "all":
-        q = q.filter(Anomaly.status == status)
+        q = q.where(Anomaly.status == status)
 
-    rows = q.order_by(Anomaly.created_at.desc()).offset(offset).limit(limit).all()
+    if cursor:
+        # Seek past the last row of the previous page — O(limit) at any depth, unlike OFFSET
+        created_at, last_id = _decode_cursor(cursor)
+        q = q.where(tuple_(Anomaly.created_at, Anomaly.id) < tuple_(literal(created_at, String()), last_id))
+    elif offset:
+        q = q.offset(offset)
+
+    rows = db.execute(q.order_by(Anomaly.created_at.desc(), Anomaly.id.desc()).limit(limit)).all()
+    if len(rows) == limit and rows[-1].created_at is not None:
+        response.headers["X-Next-Cursor"] = _encode_cursor(rows[-1].created_at, rows[-1].id)
+    # Rows come straight from our own columns, so skip per-field validation
+    return [AnomalyOut.model_construct(**row._mapping) for row in rows]
 
-    result = []
-    for anomaly, vendor_name, bill_number in rows:
-        out = AnomalyOut.model_validate(anomaly)
-        out.vendor_name = vendor_name
-        out.bill_number = bill_number
-        result.append(out)
-    return result
+
+def _encode_cursor(created_at: datetime, anomaly_id: int) -> str:
+    # isoformat drops zero microseconds, matching how SQLite stores CURRENT_TIMESTAMP,
+    # so the timestamp compares equal to the stored value for tie-breaking on id
+    raw = f"{created_at.isoformat(sep=' ')}|{anomaly_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        created_at, anomaly_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        datetime.fromisoformat(created_at)
+        return created_at, int(anomaly_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(400, "Invalid cursor")
 
 
 @router.patch("/tenants/{tenant_id}/anomalies/{anomaly_id}", response_model=AnomalyOut)
@@ -261,63 +333,87 @@ def update_anomaly(
     if tenant.id != tenant_id:
         raise HTTPException(403, "Forbidden")
 
-    anomaly = db.query(Anomaly).filter(
-        Anomaly.id == anomaly_id,
-        Anomaly.tenant_id == tenant_id,
-    ).first()
+    values = {"status": body.status}
+    if body.resolution_notes is not None:
+        values["resolution_notes"] = body.resolution_notes
+    # Single atomic UPDATE ... RETURNING instead of SELECT, UPDATE, then refresh SELECT
+    anomaly = db.execute(
+        update(Anomaly)
+        .where(Anomaly.id == anomaly_id, Anomaly.tenant_id == tenant_id)
+        .values(**values)
+        .returning(Anomaly)
+    ).scalar_one_or_none()
     if not anomaly:
         raise HTTPException(404, "Anomaly not found")
 
-    anomaly.status = body.status
-    if body.resolution_notes is not None:
-        anomaly.resolution_notes = body.resolution_notes
+    # Serialize before commit so expire-on-commit doesn't trigger a reload
+    out = AnomalyOut.model_validate(anomaly)
     db.commit()
-    db.refresh(anomaly)
-    return AnomalyOut.model_validate(anomaly)
+    return out
 
 
 @router.get("/tenants/{tenant_id}/anomalies/export")
 def export_anomalies(
     tenant_id: int = TenantIdPath,
     tenant: Tenant = Depends(get_tenant_by_key),
-    db: Session = Depends(get_db),
 ):
-    """Export anomalies as a CSV file."""
+    """Export anomalies as a CSV file, streamed as rows are fetched."""
     if tenant.id != tenant_id:
         raise HTTPException(403, "Forbidden")
 
-    rows = (
-        db.query(Anomaly, Vendor.name.label("vendor_name"), Bill.bill_number.label("bill_number"))
-        .outerjoin(Bill, Anomaly.bill_id == Bill.id)
-        .outerjoin(Vendor, Bill.vendor_id == Vendor.id)
-        .filter(Anomaly.tenant_id == tenant_id)
-        .order_by(Anomaly.created_at.desc())
-        .all()
-    )
+    def csv_chunks():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+
+        def take() -> str:
+            chunk = buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+            return chunk
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        "Date", "Vendor", "Bill #", "Anomaly Type", "Severity",
-        "Amount", "Confidence %", "Description", "Status",
-    ])
-    for anomaly, vendor_name, bill_number in rows:
         writer.writerow([
-            anomaly.created_at.date() if anomaly.created_at else "",
-            vendor_name or "",
-            bill_number or "",
-            anomaly.anomaly_type,
-            anomaly.severity,
-            f"{anomaly.amount:.2f}" if anomaly.amount is not None else "",
-            f"{anomaly.confidence_score * 100:.0f}" if anomaly.confidence_score is not None else "",
-            anomaly.description or "",
-            anomaly.status,
+            "Date", "Vendor", "Bill #", "Anomaly Type", "Severity",
+            "Amount", "Confidence %", "Description", "Status",
         ])
+        # Own session: the request-scoped one can be closed before the body finishes streaming
+        with SessionLocal() as stream_db:
+            rows = stream_db.execute(
+                select(
+                    Anomaly.created_at,
+                    Vendor.name,
+                    Bill.bill_number,
+                    Anomaly.anomaly_type,
+                    Anomaly.severity,
+                    Anomaly.amount,
+                    Anomaly.confidence_score,
+                    Anomaly.description,
+                    Anomaly.status,
+                )
+                .outerjoin(Bill, Anomaly.bill_id == Bill.id)
+                .outerjoin(Vendor, Bill.vendor_id == Vendor.id)
+                .where(Anomaly.tenant_id == tenant_id)
+                .order_by(Anomaly.created_at.desc())
+                .execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            for created_at, vendor_name, bill_number, anomaly_type, severity, amount, confidence, description, status in rows:
+                writer.writerow([
+                    created_at.date() if created_at else "",
+                    vendor_name or "",
+                    bill_number or "",
+                    anomaly_type,
+                    severity,
+                    f"{amount:.2f}" if amount is not None else "",
+                    f"{confidence * 100:.0f}" if confidence is not None else "",
+                    description or "",
+                    status,
+                ])
+                if buf.tell() >= EXPORT_CHUNK_BYTES:
+                    yield take()
+        yield take()
 
-    output.seek(0)
     filename = f"anomalies_{date.today().isoformat()}.csv"
     return StreamingResponse(
-        iter([output.getvalue()]),
+        csv_chunks(),
         media_type="text/csv",
         headers={"Content-Disposition": f"attachment; filename={filename}"},
     )
@@ -329,35 +425,56 @@ def dashboard(
     tenant: Tenant = Depends(get_tenant_by_key),
     db: Session = Depends(get_db),
 ):
-    """Dashboard summary stats."""
+    """Dashboard summary stats (cached briefly to absorb dashboard polling)."""
     if tenant.id != tenant_id:
         raise HTTPException(403, "Forbidden")
-    vendor_count = db.query(Vendor).filter(Vendor.tenant_id == tenant_id).count()
-    bill_count = db.query(Bill).filter(Bill.tenant_id == tenant_id).count()
-    anomaly_count = db.query(Anomaly).filter(Anomaly.tenant_id == tenant_id).count()
+    cached = _dashboard_cache.get(tenant_id)
+    if cached is not None:
+        return cached
+
+    # All stats come back in one round-trip as scalar subqueries of a single SELECT
+    vendor_count = select(func.count(Vendor.id)).where(Vendor.tenant_id == tenant_id).scalar_subquery()
+    bill_count = select(func.count(Bill.id)).where(Bill.tenant_id == tenant_id).scalar_subquery()
+    anomaly_count = select(func.count(Anomaly.id)).where(Anomaly.tenant_id == tenant_id).scalar_subquery()
 
     # Deduplicate by bill_id to avoid counting the same bill amount multiple times
-    # Sum distinct bill amounts that have at least one anomaly
-    distinct_bill_ids = (
-        db.query(distinct(Anomaly.bill_id))
-        .filter(Anomaly.tenant_id == tenant_id, Anomaly.bill_id.isnot(None))
+    # Sum distinct bill amounts that have at least one anomaly (JOIN, so the planner can use indexes)
+    flagged_bills = (
+        select(Anomaly.bill_id)
+        .where(Anomaly.tenant_id == tenant_id, Anomaly.bill_id.isnot(None))
+        .distinct()
         .subquery()
     )
     total_amt = (
-        db.query(func.coalesce(func.sum(Bill.total_amount), 0))
-        .filter(Bill.id.in_(distinct_bill_ids))
-        .scalar()
-    ) or 0
+        select(func.coalesce(func.sum(Bill.total_amount), 0))
+        .select_from(Bill)
+        .join(flagged_bills, Bill.id == flagged_bills.c.bill_id)
+        .scalar_subquery()
+    )
 
-    high_conf = db.query(Anomaly).filter(
-        Anomaly.tenant_id == tenant_id, Anomaly.should_alert == True
-    ).count()
+    high_conf = (
+        select(func.count(Anomaly.id))
+        .where(Anomaly.tenant_id == tenant_id, Anomaly.should_alert == True)
+        .scalar_subquery()
+    )
+
+    stats = db.execute(
+        select(
+            vendor_count.label("vendor_count"),
+            bill_count.label("bill_count"),
+            anomaly_count.label("anomaly_count"),
+            total_amt.label("total_amt"),
+            high_conf.label("high_conf"),
+        )
+    ).one()
 
-    return DashboardStats(
+    result = DashboardStats(
         tenant_id=tenant_id,
-        vendor_count=vendor_count,
-        bill_count=bill_count,
-        anomaly_count=anomaly_count,
-        total_anomaly_amount=float(total_amt),
-        high_confidence_count=high_conf,
+        vendor_count=stats.vendor_count,
+        bill_count=stats.bill_count,
+        anomaly_count=stats.anomaly_count,
+        total_anomaly_amount=float(stats.total_amt or 0),
+        high_confidence_count=stats.high_conf,
     )
+    _dashboard_cache.set(tenant_id, result)
+    return result
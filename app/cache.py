@@ -0,0 +1,49 @@
+"""In-process TTL cache — per worker; swap for Redis if entries must be shared across workers."""
+import threading
+import time
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """
+    Thread-safe mapping with per-entry expiry and a size cap.
+    When full, expired entries are dropped first, then the oldest insertions.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self._data: dict[Hashable, tuple[float, Any]] = {}
+        self._maxsize = maxsize
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value, or default if missing or expired."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            if key not in self._data and len(self._data) >= self._maxsize:
+                self._evict()
+            self._data[key] = (time.monotonic() + self._ttl, value)
+
+    def pop(self, key: Hashable) -> None:
+        """Invalidate an entry (no-op if absent)."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        expired = [k for k, (expires_at, _) in self._data.items() if expires_at < now]
+        for k in expired:
+            del self._data[k]
+        if len(self._data) >= self._maxsize:
+            # Dicts keep insertion order, so the first key is the oldest entry
+            del self._data[next(iter(self._data))]
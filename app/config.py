@@ -5,13 +5,17 @@ Load from .env via pydantic_settings. In production, set ENVIRONMENT=production
 so required secrets are validated at startup.
 """
 from pydantic import model_validator
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
     """Application settings from environment. No defaults for secrets in production."""
 
     database_url: str = "sqlite:///./ap_anomaly.db"  # Use postgresql://... for production
+    # Connection pool (ignored for SQLite); size for concurrent requests plus background syncs per worker
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_recycle_seconds: int = 1800
     qbo_client_id: str = ""
     qbo_client_secret: str = ""
     qbo_redirect_uri: str = "http://localhost:8000/api/auth/qbo/callback"
@@ -30,14 +34,18 @@ class Settings(BaseSettings):
     smtp_user: str = ""
     smtp_password: str = ""
     alert_from_email: str = ""
+    smtp_max_messages_per_connection: int = 100  # Recycle pooled SMTP connections after N messages
+    alert_flush_interval_seconds: int = 60  # Queued alerts are sent in one SMTP batch on this interval
+
+    # Background syncs: concurrent tenant syncs per process, and how long finished job status is kept
+    sync_workers: int = 4
+    sync_job_ttl_seconds: int = 3600
 
     # Rate limiting (OWASP API Security: prevent abuse and brute force)
     rate_limit_requests_per_minute_ip: int = 100
     rate_limit_requests_per_minute_user: int = 100
 
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
+    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
     @model_validator(mode="after")
     def validate_production_secrets(self):
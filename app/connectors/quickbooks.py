@@ -1,9 +1,15 @@
 """QuickBooks Online connector — OAuth 2.0 + Bill/Vendor/Payment sync."""
 import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Optional
+from typing import Any, Iterator, Optional
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from authlib.integrations.requests_client import OAuth2Session
 
 from app.config import settings
@@ -12,15 +18,39 @@ QBO_BASE = "https://quickbooks.api.intuit.com" if settings.qbo_environment == "p
 AUTH_URL = "https://appcenter.intuit.com/connect/oauth2"
 TOKEN_URL = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
 
+PAGE_SIZE = 1000
+MAX_PARALLEL_PAGES = 8  # Stays under QBO's per-realm concurrent request limit
+
+# Page requests in flight per realm, shared by every query for that realm (e.g. a sync
+# fetching vendors, bills and payments at once) so the limit holds across them
+_realm_slots: dict[str, threading.BoundedSemaphore] = {}
+_realm_slots_lock = threading.Lock()
+
+# Shared keep-alive session so API calls reuse TCP/TLS connections across pages and threads;
+# transient QBO errors and throttling (429, honoring Retry-After) are retried with backoff
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+
+# Connection pool for the token endpoint, mounted on every OAuth client so refreshes reuse a
+# warm TLS connection. Only the adapter is shared: OAuth2Session keeps the last token on itself.
+_token_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+
 
 def get_oauth_client(client_id: Optional[str] = None, client_secret: Optional[str] = None, redirect_uri: Optional[str] = None):
-    """Build OAuth2 client for QuickBooks."""
-    return OAuth2Session(
+    """Build OAuth2 client for QuickBooks. Clients hold token state, so build one per call."""
+    client = OAuth2Session(
         client_id=client_id or settings.qbo_client_id,
         client_secret=client_secret or settings.qbo_client_secret,
         redirect_uri=redirect_uri or settings.qbo_redirect_uri,
         scope="com.intuit.quickbooks.accounting",
     )
+    client.mount("https://", _token_adapter)
+    return client
 
 
 def get_authorization_url(state: Optional[str] = None) -> str:
@@ -55,104 +85,125 @@ def _headers(access_token: str) -> dict[str, str]:
 def get_company_info(access_token: str, realm_id: str) -> dict[str, Any]:
     """Fetch company info (basic validation)."""
     url = f"{QBO_BASE}/v3/company/{realm_id}/companyinfo/{realm_id}"
-    r = requests.get(url, headers=_headers(access_token), timeout=30)
+    r = _session.get(url, headers=_headers(access_token), timeout=30)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
-def fetch_vendors(access_token: str, realm_id: str) -> list[dict[str, Any]]:
-    """Fetch all vendors from QBO."""
+def _fetch_page(url: str, access_token: str, entity: str, where: str, start: int) -> list[dict[str, Any]]:
+    query = f"SELECT * FROM {entity} STARTPOSITION {start} MAXRESULTS {PAGE_SIZE}{where}"
+    r = _session.get(url, params={"query": query}, headers=_headers(access_token), timeout=60)
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    qr = data.get("QueryResponse", {})
+    return _str_ids(qr.get(entity, []))
+
+
+def _str_ids(rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Normalize entity and reference IDs to str in place, so callers can key on them without coercing."""
+    for row in rows:
+        row["Id"] = str(row["Id"])
+        vendor_ref = row.get("VendorRef")
+        if vendor_ref and "value" in vendor_ref:
+            vendor_ref["value"] = str(vendor_ref["value"])
+        for line in row.get("Line") or ():
+            for linked in line.get("LinkedTxn") or ():
+                if "TxnId" in linked:
+                    linked["TxnId"] = str(linked["TxnId"])
+    return rows
+
+
+def _count(url: str, access_token: str, entity: str, where: str) -> int:
+    query = f"SELECT COUNT(*) FROM {entity}{where}"
+    r = _session.get(url, params={"query": query}, headers=_headers(access_token), timeout=60)
+    r.raise_for_status()
+    return orjson.loads(r.content).get("QueryResponse", {}).get("totalCount", 0)
+
+
+def _iter_pages(access_token: str, realm_id: str, entity: str, where: str = "") -> Iterator[list[dict[str, Any]]]:
+    """
+    Page through a QBO query, yielding each page in order. The first page is fetched alone;
+    if it comes back full, a COUNT query sizes the rest, which are then fetched MAX_PARALLEL_PAGES
+    at a time — no requests past the last page. A short page (rows deleted meanwhile) stops early.
+    """
     url = f"{QBO_BASE}/v3/company/{realm_id}/query"
+    with _realm_slots_lock:
+        slots = _realm_slots.setdefault(realm_id, threading.BoundedSemaphore(MAX_PARALLEL_PAGES))
+
+    def fetch(start: int) -> list[dict[str, Any]]:
+        with slots:
+            return _fetch_page(url, access_token, entity, where, start)
+
+    page = fetch(1)
+    yield page
+    if len(page) < PAGE_SIZE:
+        return
+    with slots:
+        total = _count(url, access_token, entity, where)
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PAGES) as pool:
+        in_flight = deque(pool.submit(fetch, start) for start in range(1 + PAGE_SIZE, total + 1, PAGE_SIZE))
+        try:
+            while in_flight:
+                page = in_flight.popleft().result()
+                yield page
+                if len(page) < PAGE_SIZE:
+                    return
+        finally:
+            # Stopped early (short page, error, or the caller quit): don't send requests not yet started
+            for future in in_flight:
+                future.cancel()
+
+
+def _query_all(access_token: str, realm_id: str, entity: str, where: str = "") -> list[dict[str, Any]]:
+    """Fetch every row of a QBO query into one list."""
     results = []
-    start = 1
-    page_size = 1000
-    while True:
-        query = f"SELECT * FROM Vendor STARTPOSITION {start} MAXRESULTS {page_size}"
-        r = requests.get(url, params={"query": query}, headers=_headers(access_token), timeout=60)
-        r.raise_for_status()
-        data = r.json()
-        qr = data.get("QueryResponse", {})
-        vendors = qr.get("Vendor", [])
-        if not vendors:
-            break
-        results.extend(vendors)
-        if len(vendors) < page_size:
-            break
-        start += page_size
+    for page in _iter_pages(access_token, realm_id, entity, where):
+        results.extend(page)
     return results
 
 
-def fetch_bills(access_token: str, realm_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None):
-    """Fetch bills from QBO. Optional date range (YYYY-MM-DD)."""
-    url = f"{QBO_BASE}/v3/company/{realm_id}/query"
-    results = []
-    start = 1
-    page_size = 1000
+def _date_where(start_date: Optional[str], end_date: Optional[str]) -> str:
     date_clause = ""
     if start_date:
         date_clause += f" AND TxnDate >= '{start_date}'"
     if end_date:
         date_clause += f" AND TxnDate <= '{end_date}'"
-    while True:
-        query = f"SELECT * FROM Bill STARTPOSITION {start} MAXRESULTS {page_size} WHERE 1=1 {date_clause}"
-        r = requests.get(url, params={"query": query}, headers=_headers(access_token), timeout=60)
-        r.raise_for_status()
-        data = r.json()
-        qr = data.get("QueryResponse", {})
-        bills = qr.get("Bill", [])
-        if not bills:
-            break
-        results.extend(bills)
-        if len(bills) < page_size:
-            break
-        start += page_size
-    return results
+    return f" WHERE 1=1 {date_clause}"
+
+
+def fetch_vendors(access_token: str, realm_id: str) -> list[dict[str, Any]]:
+    """Fetch all vendors from QBO."""
+    return _query_all(access_token, realm_id, "Vendor")
+
+
+def iter_bills(access_token: str, realm_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None):
+    """Yield bills from QBO one page (up to PAGE_SIZE) at a time, so callers can process them incrementally."""
+    return _iter_pages(access_token, realm_id, "Bill", _date_where(start_date, end_date))
 
 
 def fetch_bill_payments(access_token: str, realm_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None):
     """Fetch BillPayment transactions from QBO."""
-    url = f"{QBO_BASE}/v3/company/{realm_id}/query"
-    results = []
-    start = 1
-    page_size = 1000
-    date_clause = ""
-    if start_date:
-        date_clause += f" AND TxnDate >= '{start_date}'"
-    if end_date:
-        date_clause += f" AND TxnDate <= '{end_date}'"
-    while True:
-        query = f"SELECT * FROM BillPayment STARTPOSITION {start} MAXRESULTS {page_size} WHERE 1=1 {date_clause}"
-        r = requests.get(url, params={"query": query}, headers=_headers(access_token), timeout=60)
-        r.raise_for_status()
-        data = r.json()
-        qr = data.get("QueryResponse", {})
-        payments = qr.get("BillPayment", [])
-        if not payments:
-            break
-        results.extend(payments)
-        if len(payments) < page_size:
-            break
-        start += page_size
-    return results
+    return _query_all(access_token, realm_id, "BillPayment", _date_where(start_date, end_date))
 
 
 def parse_bill_line_items(bill: dict[str, Any]) -> list[dict[str, Any]]:
-    """Extract line items from a QBO Bill."""
+    """Extract line items from a QBO Bill. Amounts are JSON numbers already, so they're passed through."""
     lines = []
     for line in bill.get("Line", []) or []:
         if line.get("DetailType") == "ItemBasedExpenseLineDetail":
             detail = line.get("ItemBasedExpenseLineDetail", {}) or {}
             lines.append({
                 "description": line.get("Description"),
-                "amount": float(line.get("Amount", 0)),
-                "quantity": float(detail.get("Qty", 1)),
-                "unit_price": float(detail.get("UnitPrice", 0)) if detail.get("UnitPrice") else None,
+                "amount": line.get("Amount", 0.0),
+                "quantity": detail.get("Qty", 1),
+                "unit_price": detail.get("UnitPrice") or None,
             })
         elif line.get("DetailType") == "AccountBasedExpenseLineDetail":
+            amount = line.get("Amount", 0.0)
             lines.append({
                 "description": line.get("Description"),
-                "amount": float(line.get("Amount", 0)),
+                "amount": amount,
                 "quantity": 1,
-                "unit_price": float(line.get("Amount", 0)),
+                "unit_price": amount,
             })
     return lines
@@ -1,6 +1,8 @@
 """Database setup and session management."""
-from sqlalchemy import create_engine
+import orjson
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import DeclarativeBase, sessionmaker, Session
+from sqlalchemy.pool import StaticPool
 
 from app.config import settings
 
@@ -11,14 +13,42 @@ class Base(DeclarativeBase):
     pass
 
 
-# SQLite needs check_same_thread=False
-connect_args = {} if "sqlite" not in settings.database_url else {"check_same_thread": False}
+def _engine_options(url: str) -> dict:
+    """Pool settings per backend: a sized, health-checked pool for servers; SQLite stays simple."""
+    if not url.startswith("sqlite"):
+        return {
+            "pool_size": settings.db_pool_size,
+            "max_overflow": settings.db_max_overflow,
+            "pool_pre_ping": True,  # Drop connections the server closed while idle
+            "pool_recycle": settings.db_pool_recycle_seconds,
+        }
+    # SQLite needs check_same_thread=False
+    options = {"connect_args": {"check_same_thread": False}}
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        # In-memory DB exists per connection — every session must share the one connection
+        options["poolclass"] = StaticPool
+    return options
+
+
 engine = create_engine(
     settings.database_url,
     echo=False,
-    connect_args=connect_args,
+    # JSON/JSONB columns (anomaly metadata) go through orjson rather than the stdlib json module
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads,
+    **_engine_options(settings.database_url),
 )
 
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL lets readers proceed during writes; NORMAL sync is safe with WAL and much faster
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
@@ -1,6 +1,8 @@
 """Anomaly detection: duplicates, price outliers, round numbers."""
-import json
 from datetime import timedelta
+
+import numpy as np
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 from app.config import settings
@@ -9,152 +11,163 @@ from app.pipeline.baselines import compute_baselines
 
 
 def run_detection(tenant_id: int, db: Session) -> int:
-    """Run all anomaly detectors. Returns count of new anomalies."""
-    compute_baselines(tenant_id, db)
-    count = 0
-    count += _detect_duplicates(tenant_id, db)
-    count += _detect_price_outliers(tenant_id, db)
-    count += _detect_round_numbers(tenant_id, db)
+    """Run all anomaly detectors in one transaction. Returns count of new anomalies."""
+    with db.no_autoflush:
+        compute_baselines(tenant_id, db)
+        # The outlier join reads baselines server-side; send them without committing
+        db.flush()
+        # (bill_id, anomaly_type) pairs already flagged; detectors add to it as they go
+        existing = set(
+            db.query(Anomaly.bill_id, Anomaly.anomaly_type)
+            .filter(Anomaly.tenant_id == tenant_id)
+            .all()
+        )
+        count = 0
+        count += _detect_duplicates(tenant_id, db, existing)
+        count += _detect_price_outliers(tenant_id, db, existing)
+        count += _detect_round_numbers(tenant_id, db, existing)
+    db.commit()
     return count
 
 
-def _detect_duplicates(tenant_id: int, db: Session) -> int:
+def _detect_duplicates(tenant_id: int, db: Session, existing: set[tuple[int, str]]) -> int:
     """Flag bills with same vendor + amount within N days (exact or near-duplicate)."""
     window = settings.duplicate_day_window
+    alert_min_amount = settings.alert_min_amount
+    description = f"Possible duplicate: same vendor and amount within {window} days"
     bills = (
-        db.query(Bill)
+        db.query(Bill.id, Bill.vendor_id, Bill.total_amount, Bill.txn_date)
         .filter(Bill.tenant_id == tenant_id)
-        .order_by(Bill.txn_date)
         .all()
     )
-    seen = {}  # (vendor_id, round(amount, 2)) -> [(bill_id, txn_date, amount), ...]
-    for b in bills:
-        key = (b.vendor_id, round(b.total_amount, 2))
-        lst = seen.setdefault(key, [])
-        lst.append((b.id, b.txn_date, b.total_amount))
-    count = 0
-    for key, lst in seen.items():
-        if len(lst) < 2:
+    n = len(bills)
+    if n < 2:
+        return 0
+    # Column arrays (SoA) so grouping and the window check run in numpy, not per pair in Python
+    ids = np.fromiter((b.id for b in bills), dtype=np.int64, count=n)
+    vendor_ids = np.fromiter((b.vendor_id for b in bills), dtype=np.int64, count=n)
+    amounts = np.fromiter((b.total_amount for b in bills), dtype=np.float64, count=n)
+    cents = np.rint(amounts * 100).astype(np.int64)
+    dates = np.array([b.txn_date for b in bills], dtype="datetime64[D]")
+    # Bucket by (vendor, amount in whole cents), date order within a bucket (id breaks ties)
+    order = np.lexsort((ids, dates, cents, vendor_ids))
+    ids, vendor_ids, amounts, cents, dates = (arr[order] for arr in (ids, vendor_ids, amounts, cents, dates))
+    # Dates are sorted within a bucket, so a bill has a later bill within the window
+    # exactly when the next one is: flag bill i against bill i + 1.
+    same_bucket = (vendor_ids[1:] == vendor_ids[:-1]) & (cents[1:] == cents[:-1])
+    in_window = (dates[1:] - dates[:-1]) <= np.timedelta64(window, "D")
+    hits = np.flatnonzero(same_bucket & in_window)
+    ids_list = ids.tolist()
+    amounts_list = amounts.tolist()
+    pending = []
+    for i in hits.tolist():
+        bid, bid2, amt = ids_list[i], ids_list[i + 1], amounts_list[i]
+        # Check we haven't already flagged this bill
+        if (bid, "duplicate") in existing:
             continue
-        for i, (bid, d, amt) in enumerate(lst):
-            for j, (bid2, d2, amt2) in enumerate(lst):
-                if i >= j:
-                    continue
-                if abs((d - d2).days) <= window:
-                    # Check we haven't already flagged this bill
-                    existing = (
-                        db.query(Anomaly)
-                        .filter(
-                            Anomaly.tenant_id == tenant_id,
-                            Anomaly.bill_id == bid,
-                            Anomaly.anomaly_type == "duplicate",
-                        )
-                        .first()
-                    )
-                    if existing:
-                        continue
-                    should_alert = amt >= settings.alert_min_amount
-                    meta = json.dumps({"related_bill_id": bid2, "duplicate_of": bid})
-                    a = Anomaly(
-                        tenant_id=tenant_id,
-                        bill_id=bid,
-                        anomaly_type="duplicate",
-                        severity="high" if amt >= 1000 else "medium",
-                        amount=amt,
-                        confidence_score=0.95,
-                        description=f"Possible duplicate: same vendor and amount within {window} days",
-                        metadata_json=meta,
-                        should_alert=should_alert,
-                    )
-                    db.add(a)
-                    count += 1
-                    # No break — continue checking other pairs so bill3, bill4 etc. are also flagged
-    return count
+        pending.append(dict(
+            tenant_id=tenant_id,
+            bill_id=bid,
+            anomaly_type="duplicate",
+            severity="high" if amt >= 1000 else "medium",
+            amount=amt,
+            confidence_score=0.95,
+            description=description,
+            metadata_json={"related_bill_id": bid2, "duplicate_of": bid},
+            should_alert=amt >= alert_min_amount,
+        ))
+        existing.add((bid, "duplicate"))
+    if pending:
+        db.bulk_insert_mappings(Anomaly, pending)
+    return len(pending)
 
 
-def _detect_price_outliers(tenant_id: int, db: Session) -> int:
+def _detect_price_outliers(tenant_id: int, db: Session, existing: set[tuple[int, str]]) -> int:
     """Flag bills where amount is >2σ above vendor baseline."""
     sigma = settings.alert_sigma_threshold
-    baselines = (
-        db.query(VendorBaseline, Vendor)
-        .join(Vendor, VendorBaseline.vendor_id == Vendor.id)
+    # Each vendor keeps a baseline row per window; only its newest (highest id) one applies
+    latest = (
+        db.query(func.max(VendorBaseline.id).label("id"))
+        .join(Vendor, Vendor.id == VendorBaseline.vendor_id)
         .filter(Vendor.tenant_id == tenant_id)
+        .group_by(VendorBaseline.vendor_id)
+        .subquery()
+    )
+    # One round-trip: the DB joins bills to their vendor's baseline and returns only outliers
+    outliers = (
+        db.query(Bill.id, Bill.total_amount, VendorBaseline.avg_amount, VendorBaseline.std_amount)
+        .join(VendorBaseline, VendorBaseline.vendor_id == Bill.vendor_id)
+        .join(latest, latest.c.id == VendorBaseline.id)
+        .filter(
+            Bill.tenant_id == tenant_id,
+            VendorBaseline.std_amount > 0,
+            Bill.total_amount > VendorBaseline.avg_amount + sigma * VendorBaseline.std_amount,
+        )
+        .order_by(Bill.id)
         .all()
     )
-    count = 0
-    for baseline, vendor in baselines:
-        if baseline.std_amount is None or baseline.std_amount <= 0:
+    if not outliers:
+        return 0
+    # z-scores and confidences for the whole batch in one vectorized pass
+    n = len(outliers)
+    amounts = np.fromiter((b.total_amount for b in outliers), dtype=np.float64, count=n)
+    avgs = np.fromiter((b.avg_amount for b in outliers), dtype=np.float64, count=n)
+    stds = np.fromiter((b.std_amount for b in outliers), dtype=np.float64, count=n)
+    zs = (amounts - avgs) / stds
+    confidences = np.minimum(0.99, 0.5 + zs / 10)
+    pending = []
+    for b, z, confidence in zip(outliers, zs.tolist(), confidences.tolist()):
+        if (b.id, "price_creep") in existing:
             continue
-        threshold = baseline.avg_amount + sigma * baseline.std_amount
-        bills = (
-            db.query(Bill)
-            .filter(Bill.vendor_id == vendor.id, Bill.total_amount > threshold)
-            .all()
-        )
-        for b in bills:
-            z = (b.total_amount - baseline.avg_amount) / baseline.std_amount
-            existing = (
-                db.query(Anomaly)
-                .filter(
-                    Anomaly.tenant_id == tenant_id,
-                    Anomaly.bill_id == b.id,
-                    Anomaly.anomaly_type == "price_creep",
-                )
-                .first()
-            )
-            if existing:
-                continue
-            should_alert = b.total_amount >= settings.alert_min_amount or z >= sigma
-            a = Anomaly(
-                tenant_id=tenant_id,
-                bill_id=b.id,
-                anomaly_type="price_creep",
-                severity="high" if z >= 3 else "medium",
-                amount=b.total_amount,
-                confidence_score=min(0.99, 0.5 + z / 10),
-                description=f"Amount {b.total_amount:.2f} is {z:.1f}σ above vendor baseline ({baseline.avg_amount:.2f})",
-                metadata_json=json.dumps({"z_score": z, "baseline_avg": baseline.avg_amount, "baseline_std": baseline.std_amount}),
-                should_alert=should_alert,
-            )
-            db.add(a)
-            count += 1
-    return count
+        should_alert = b.total_amount >= settings.alert_min_amount or z >= sigma
+        pending.append(dict(
+            tenant_id=tenant_id,
+            bill_id=b.id,
+            anomaly_type="price_creep",
+            severity="high" if z >= 3 else "medium",
+            amount=b.total_amount,
+            confidence_score=confidence,
+            description=f"Amount {b.total_amount:.2f} is {z:.1f}σ above vendor baseline ({b.avg_amount:.2f})",
+            metadata_json={"z_score": z, "baseline_avg": b.avg_amount, "baseline_std": b.std_amount},
+            should_alert=should_alert,
+        ))
+        existing.add((b.id, "price_creep"))
+    if pending:
+        db.bulk_insert_mappings(Anomaly, pending)
+    return len(pending)
 
 
-def _detect_round_numbers(tenant_id: int, db: Session) -> int:
+def _detect_round_numbers(tenant_id: int, db: Session, existing: set[tuple[int, str]]) -> int:
     """Flag suspicious round-number totals with no line items (potential data entry shortcuts)."""
-    bills = db.query(Bill).filter(Bill.tenant_id == tenant_id).all()
-    count = 0
+    # Flag any multiple of $500 — covers $500, $1k, $1.5k, $3k, $7.5k, etc.
+    # (round() rather than %, which PostgreSQL doesn't define for floats)
+    bills = (
+        db.query(Bill.id, Bill.total_amount)
+        .filter(
+            Bill.tenant_id == tenant_id,
+            Bill.has_line_items.isnot(True),
+            Bill.total_amount >= settings.alert_min_amount,
+            Bill.total_amount == func.round(Bill.total_amount / 500) * 500,
+        )
+        .yield_per(1000)
+    )
+    pending = []
     for b in bills:
-        if b.has_line_items:
+        if (b.id, "round_number") in existing:
             continue
         amt = b.total_amount
-        if amt < settings.alert_min_amount:
-            continue
-        # Flag any multiple of $500 — covers $500, $1k, $1.5k, $3k, $7.5k, etc.
-        if amt % 500 == 0:
-            existing = (
-                db.query(Anomaly)
-                .filter(
-                    Anomaly.tenant_id == tenant_id,
-                    Anomaly.bill_id == b.id,
-                    Anomaly.anomaly_type == "round_number",
-                )
-                .first()
-            )
-            if existing:
-                continue
-            a = Anomaly(
-                tenant_id=tenant_id,
-                bill_id=b.id,
-                anomaly_type="round_number",
-                severity="low",
-                amount=amt,
-                confidence_score=0.6,
-                description=f"Round number (${amt:,.0f}) with no line-item detail — consider verifying against source invoice",
-                metadata_json=json.dumps({"round_value": amt}),
-                should_alert=amt >= settings.alert_min_amount,
-            )
-            db.add(a)
-            count += 1
-    return count
+        pending.append(dict(
+            tenant_id=tenant_id,
+            bill_id=b.id,
+            anomaly_type="round_number",
+            severity="low",
+            amount=amt,
+            confidence_score=0.6,
+            description=f"Round number (${amt:,.0f}) with no line-item detail — consider verifying against source invoice",
+            metadata_json={"round_value": amt},
+            should_alert=amt >= settings.alert_min_amount,
+        ))
+        existing.add((b.id, "round_number"))
+    if pending:
+        db.bulk_insert_mappings(Anomaly, pending)
+    return len(pending)
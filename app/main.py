@@ -1,4 +1,6 @@
 """FastAPI application entry point."""
+import asyncio
+import contextlib
 import logging
 import logging.config
 from contextlib import asynccontextmanager
@@ -9,9 +11,11 @@ from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse
 
 from app.api.routes import router
-from app.database import init_db
+from app.database import engine, init_db
 from app.config import settings
 from app.middleware.rate_limit import RateLimitMiddleware
+from app.alerts.email import close_smtp_pools, flush_pending_alerts, run_alert_flusher
+from app.pipeline.jobs import shutdown_sync_workers
 
 # Configure structured logging at startup
 logging.config.dictConfig({
@@ -48,8 +52,19 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         # Don't block startup: server must bind so /health passes (e.g. Railway healthcheck)
         logger.warning("Database init failed (server will start anyway): %s", e)
+    # Compile page templates up front so the first request doesn't pay for it
+    for name in ("index.html", "dashboard.html"):
+        templates.get_template(name)
+    alert_flusher = asyncio.create_task(run_alert_flusher(settings.alert_flush_interval_seconds))
     yield
     logger.info("A/P Anomaly Detector shutting down")
+    alert_flusher.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await alert_flusher
+    shutdown_sync_workers()
+    # Don't drop alerts queued since the last flush; this waits out a flush still running in its thread
+    flush_pending_alerts()
+    close_smtp_pools()
 
 
 app = FastAPI(
@@ -70,6 +85,8 @@ app.add_middleware(
 app.include_router(router, prefix="/api", tags=["api"])
 
 templates = Jinja2Templates(directory=str(templates_dir))
+# Templates only change on deploy in production — skip the per-render mtime stat there
+templates.env.auto_reload = settings.environment != "production"
 
 
 @app.get("/")
@@ -87,3 +104,12 @@ def dashboard(request: Request):
 @app.get("/health")
 def health():
     return {"status": "ok"}
+
+
+if settings.environment != "production":
+    @app.get("/debug/pool", include_in_schema=False)
+    def debug_pool():
+        """Connection pool usage, to check the pool isn't exhausted under concurrent syncs."""
+        pool = engine.pool
+        stats = {name: getattr(pool, name)() for name in ("size", "checkedin", "checkedout", "overflow") if hasattr(pool, name)}
+        return {"pool": type(pool).__name__, **stats}
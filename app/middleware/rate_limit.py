@@ -9,12 +9,12 @@ Returns 429 Too Many Requests with Retry-After when either limit is exceeded.
 """
 import time
 import logging
-from collections import defaultdict
-from typing import Callable, Optional
+from functools import lru_cache
+from typing import Optional
 
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+from starlette.requests import HTTPConnection
 from starlette.responses import Response, JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 logger = logging.getLogger(__name__)
 
@@ -27,57 +27,69 @@ WINDOW_SECONDS = 60
 class InMemoryRateLimitStore:
     """
     In-memory store for rate limit counters.
-    Keys are (identifier, window_start). Counts reset each window.
+    Holds counts for the current window only; the dict is swapped out when the window rolls over.
     For production at scale, replace with Redis.
     """
 
     def __init__(self, window_seconds: int = WINDOW_SECONDS):
-        self._counts: dict[tuple[str, int], int] = defaultdict(int)
         self._window = window_seconds
-
-    def _window_start(self) -> int:
-        return int(time.time() // self._window) * self._window
-
-    def increment(self, key: str) -> int:
-        """Increment count for key in current window; return new count."""
-        w = self._window_start()
-        self._counts[(key, w)] += 1
-        return self._counts[(key, w)]
-
-    def get_count(self, key: str) -> int:
+        self._current_window = self._window_start(int(time.monotonic()))
+        self._counts: dict[str, int] = {}
+
+    def _window_start(self, now: int) -> int:
+        return now - now % self._window
+
+    def _rollover(self, now: Optional[int]) -> None:
+        """Start a fresh dict on a new window — O(1), no scan over old keys."""
+        w = self._window_start(int(time.monotonic()) if now is None else now)
+        if w != self._current_window:
+            self._current_window = w
+            self._counts = {}
+
+    def increment(self, key: str, now: Optional[int] = None) -> int:
+        """Increment count for key in current window; return new count.
+
+        `now` is whole seconds from time.monotonic(); pass it to share one clock read per request.
+        """
+        self._rollover(now)
+        count = self._counts.get(key, 0) + 1
+        self._counts[key] = count
+        return count
+
+    def get_count(self, key: str, now: Optional[int] = None) -> int:
         """Return current count for key in current window."""
-        w = self._window_start()
-        return self._counts.get((key, w), 0)
+        self._rollover(now)
+        return self._counts.get(key, 0)
+
 
-    def cleanup_old(self):
-        """Drop entries from previous windows to avoid unbounded growth."""
-        w = self._window_start()
-        to_drop = [k for k in self._counts if k[1] < w]
-        for k in to_drop:
-            del self._counts[k]
+# Module-level stores so the same instances are used across requests. One store per
+# identifier kind lets the raw IP / API key be the dict key, with no prefixed string per request.
+_stores: dict[str, InMemoryRateLimitStore] = {}
 
 
-# Module-level store so the same instance is used across requests
-_store: Optional[InMemoryRateLimitStore] = None
+def get_store(kind: str = "ip") -> InMemoryRateLimitStore:
+    store = _stores.get(kind)
+    if store is None:
+        store = _stores[kind] = InMemoryRateLimitStore()
+    return store
 
 
-def get_store() -> InMemoryRateLimitStore:
-    global _store
-    if _store is None:
-        _store = InMemoryRateLimitStore()
-    return _store
+@lru_cache(maxsize=4096)
+def _parse_xff(header: str) -> str:
+    """First element of X-Forwarded-For is the client IP (appendees are proxies).
+    Cached: bursts through the same proxy chain repeat the exact header."""
+    return header.partition(",")[0].strip()
 
 
-def get_client_ip(request: Request) -> str:
+def get_client_ip(request: HTTPConnection) -> str:
     """Resolve client IP, respecting X-Forwarded-For when behind a proxy (e.g. load balancer)."""
     forwarded = request.headers.get("x-forwarded-for")
     if forwarded:
-        # First element is the client IP (appendees are proxies)
-        return forwarded.split(",")[0].strip()
+        return _parse_xff(forwarded)
     return request.client.host if request.client else "0.0.0.0"
 
 
-def get_api_key_from_request(request: Request) -> Optional[str]:
+def get_api_key_from_request(request: HTTPConnection) -> Optional[str]:
     """Extract X-API-Key from request if present; used for user-based rate limiting."""
     return request.headers.get("x-api-key") or request.headers.get("X-API-Key")
 
@@ -94,46 +106,52 @@ def _rate_limit_response(retry_after_seconds: int = 60) -> Response:
     )
 
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
+class RateLimitMiddleware:
     """
     Applies IP-based and (when present) user-based rate limits.
     Exempts health check and static assets to avoid blocking monitoring.
+    Plain ASGI middleware: no per-request task group or response streaming as with BaseHTTPMiddleware.
     """
 
     def __init__(
         self,
-        app,
+        app: ASGIApp,
         requests_per_minute_ip: int = DEFAULT_REQUESTS_PER_MINUTE_IP,
         requests_per_minute_user: int = DEFAULT_REQUESTS_PER_MINUTE_USER,
         exempt_paths: Optional[list[str]] = None,
     ):
-        super().__init__(app)
+        self.app = app
         self.rpm_ip = requests_per_minute_ip
         self.rpm_user = requests_per_minute_user
         self.exempt = set(exempt_paths or ["/health", "/"])
-
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        path = request.url.path
+        # Exact matches hit the set; subpaths go through a single tuple startswith
+        self._exempt_prefixes = tuple(p + "/" for p in self.exempt)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
         # Exempt health and landing so load balancers and users are not blocked
-        if any(path == p or path.startswith(p + "/") for p in self.exempt):
-            return await call_next(request)
-
-        store = get_store()
-        store.cleanup_old()
-
-        client_ip = get_client_ip(request)
-        ip_key = f"ip:{client_ip}"
-        ip_count = store.increment(ip_key)
+        if path in self.exempt or path.startswith(self._exempt_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        now = int(time.monotonic())
+        conn = HTTPConnection(scope)
+        client_ip = get_client_ip(conn)
+        ip_count = get_store("ip").increment(client_ip, now)
         if ip_count > self.rpm_ip:
             logger.warning("Rate limit exceeded for IP %s", client_ip)
-            return _rate_limit_response(retry_after_seconds=WINDOW_SECONDS)
+            await _rate_limit_response(retry_after_seconds=WINDOW_SECONDS)(scope, receive, send)
+            return
 
-        api_key = get_api_key_from_request(request)
+        api_key = get_api_key_from_request(conn)
         if api_key:
-            user_key = f"key:{api_key}"
-            user_count = store.increment(user_key)
+            user_count = get_store("key").increment(api_key, now)
             if user_count > self.rpm_user:
                 logger.warning("Rate limit exceeded for API key (user-based)")
-                return _rate_limit_response(retry_after_seconds=WINDOW_SECONDS)
+                await _rate_limit_response(retry_after_seconds=WINDOW_SECONDS)(scope, receive, send)
+                return
 
-        return await call_next(request)
+        await self.app(scope, receive, send)
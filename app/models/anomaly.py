@@ -1,5 +1,6 @@
 """Anomaly detection result."""
-from sqlalchemy import Column, Integer, Float, String, ForeignKey, DateTime, Text, Boolean
+from sqlalchemy import Column, Integer, Float, String, ForeignKey, DateTime, Text, Boolean, Index, JSON, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -23,7 +24,7 @@ class Anomaly(Base):
     amount = Column(Float)
     confidence_score = Column(Float)  # 0-1, for alert threshold
     description = Column(Text)
-    metadata_json = Column(Text)  # JSON: related_bill_id, z_score, etc.
+    metadata_json = Column(JSON().with_variant(JSONB, "postgresql"))  # related_bill_id, z_score, etc.
 
     # Only alert (email/push) if True — avoid fatigue
     should_alert = Column(Boolean, default=False)
@@ -36,4 +37,21 @@ class Anomaly(Base):
     acknowledged_at = Column(DateTime(timezone=True))
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+    __table_args__ = (
+        # list/export/alert lookups: filter tenant + status, newest first (btree scans backwards for DESC);
+        # id is the keyset-pagination tie-breaker
+        Index("ix_anomaly_tenant_status_created", "tenant_id", "status", "created_at", "id"),
+        # High-confidence counts — partial index since most rows have should_alert = false
+        Index(
+            "ix_anomaly_tenant_alert",
+            "tenant_id",
+            "should_alert",
+            postgresql_where=text("should_alert = true"),
+            sqlite_where=text("should_alert = 1"),
+        ),
+        # Detection's (bill_id, anomaly_type) preload and the dashboard's distinct flagged bills;
+        # covers both, so they can be index-only scans
+        Index("ix_anomaly_tenant_bill_type", "tenant_id", "bill_id", "anomaly_type"),
+    )
+
     tenant = relationship("Tenant", back_populates="anomalies")
@@ -23,7 +23,7 @@ class Tenant(Base):
     token_expires_at = Column(DateTime(timezone=True))
 
     # API authentication
-    api_key = Column(String(64), unique=True, index=True)
+    api_key = Column(String(64), unique=True, index=True, nullable=False)  # Unique btree — auth is an index seek
 
     # Email alerts
     alert_email = Column(String(255))
@@ -1,5 +1,5 @@
 """Vendor model."""
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -19,5 +19,9 @@ class Vendor(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+    __table_args__ = (
+        UniqueConstraint("tenant_id", "external_id", name="uq_vendor_tenant_external"),
+    )
+
     tenant = relationship("Tenant", back_populates="vendors")
     bills = relationship("Bill", back_populates="vendor")
@@ -1,5 +1,7 @@
 """Compute vendor baselines for anomaly detection."""
 from datetime import date, timedelta
+
+import numpy as np
 from sqlalchemy import func
 from sqlalchemy.orm import Session
 
@@ -8,70 +10,77 @@ from app.models import Bill, Vendor, VendorBaseline
 
 
 def compute_baselines(tenant_id: int, db: Session) -> int:
-    """Compute 90-day baselines per vendor. Returns count of baselines created/updated."""
+    """Compute 90-day baselines per vendor. Returns count of baselines created/updated.
+
+    Changes are left in the session; the caller commits.
+    """
     end = date.today()
     start = end - timedelta(days=settings.baseline_days)
-    vendors = db.query(Vendor).filter(Vendor.tenant_id == tenant_id).all()
-    count = 0
-    for vendor in vendors:
-        rows = (
-            db.query(
-                func.count(Bill.id).label("cnt"),
-                func.avg(Bill.total_amount).label("avg_amt"),
-                func.min(Bill.total_amount).label("min_amt"),
-                func.max(Bill.total_amount).label("max_amt"),
-            )
-            .filter(
-                Bill.vendor_id == vendor.id,
-                Bill.txn_date >= start,
-                Bill.txn_date <= end,
-            )
-            .first()
+    in_window = (
+        Vendor.tenant_id == tenant_id,
+        Bill.txn_date >= start,
+        Bill.txn_date <= end,
+    )
+    # Sample std dev (Bessel's correction: divide by n-1); only PostgreSQL has stddev_samp
+    has_stddev = db.get_bind().dialect.name == "postgresql"
+    stats = (
+        db.query(
+            Bill.vendor_id,
+            func.count(Bill.id).label("cnt"),
+            func.avg(Bill.total_amount).label("avg_amt"),
+            func.min(Bill.total_amount).label("min_amt"),
+            func.max(Bill.total_amount).label("max_amt"),
+            *([func.stddev_samp(Bill.total_amount).label("std_amt")] if has_stddev else []),
         )
-        if not rows or rows.cnt == 0:
-            continue
-        # Compute sample std dev (Bessel's correction: divide by n-1)
-        amounts = (
-            db.query(Bill.total_amount)
-            .filter(
-                Bill.vendor_id == vendor.id,
-                Bill.txn_date >= start,
-                Bill.txn_date <= end,
-            )
-            .all()
-        )
-        vals = [a[0] for a in amounts]
-        n = len(vals)
-        avg = sum(vals) / n
-        variance = sum((x - avg) ** 2 for x in vals) / (n - 1) if n > 1 else 0
-        std = variance ** 0.5
-        baseline = (
-            db.query(VendorBaseline)
-            .filter(
-                VendorBaseline.vendor_id == vendor.id,
-                VendorBaseline.window_start == start,
-                VendorBaseline.window_end == end,
-            )
-            .first()
+        .join(Vendor, Bill.vendor_id == Vendor.id)
+        .filter(*in_window)
+        .group_by(Bill.vendor_id)
+        .all()
+    )
+    if not stats:
+        return 0
+    if has_stddev:
+        stds = {row.vendor_id: row.std_amt or 0 for row in stats}
+    else:
+        amounts: dict[int, list[float]] = {}
+        for vendor_id, amt in (
+            db.query(Bill.vendor_id, Bill.total_amount)
+            .join(Vendor, Bill.vendor_id == Vendor.id)
+            .filter(*in_window)
+        ):
+            amounts.setdefault(vendor_id, []).append(amt)
+        stds = {}
+        for vendor_id, vals in amounts.items():
+            arr = np.asarray(vals, dtype=np.float64)
+            stds[vendor_id] = float(arr.std(ddof=1)) if arr.size > 1 else 0.0
+    existing = {
+        b.vendor_id: b
+        for b in db.query(VendorBaseline).filter(
+            VendorBaseline.vendor_id.in_([row.vendor_id for row in stats]),
+            VendorBaseline.window_start == start,
+            VendorBaseline.window_end == end,
         )
+    }
+    count = 0
+    for row in stats:
+        baseline = existing.get(row.vendor_id)
         if baseline:
-            baseline.avg_amount = avg
-            baseline.std_amount = std
-            baseline.min_amount = rows.min_amt
-            baseline.max_amount = rows.max_amt
-            baseline.payment_count = n
+            baseline.avg_amount = row.avg_amt
+            baseline.std_amount = stds[row.vendor_id]
+            baseline.min_amount = row.min_amt
+            baseline.max_amount = row.max_amt
+            baseline.payment_count = row.cnt
         else:
             baseline = VendorBaseline(
-                vendor_id=vendor.id,
+                vendor_id=row.vendor_id,
                 window_start=start,
                 window_end=end,
-                avg_amount=avg,
-                std_amount=std,
-                min_amount=rows.min_amt,
-                max_amount=rows.max_amt,
-                payment_count=n,
+                avg_amount=row.avg_amt,
+                std_amount=stds[row.vendor_id],
+                min_amount=row.min_amt,
+                max_amount=row.max_amt,
+                payment_count=row.cnt,
             )
             db.add(baseline)
             count += 1
-    db.commit()
     return count
@@ -0,0 +1,73 @@
+"""Background sync jobs — run on a per-process worker pool so API requests return immediately."""
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from app.cache import TTLCache
+from app.config import settings
+from app.pipeline.sync import sync_tenant_task
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=settings.sync_workers, thread_name_prefix="sync")
+# job_id -> status dict for queued/running jobs; they stay until they finish, however long that takes
+_pending_jobs: dict[str, dict[str, Any]] = {}
+# job_id -> status dict for finished jobs; these expire so the registry stays bounded
+_finished_jobs = TTLCache(maxsize=10_000, ttl_seconds=settings.sync_job_ttl_seconds)
+# tenant_id -> job_id of its queued/running sync, so repeat requests don't stack syncs
+_active: dict[int, str] = {}
+_lock = threading.Lock()
+
+
+def enqueue_sync(tenant_id: int, on_finish: Optional[Callable[[], None]] = None) -> dict[str, Any]:
+    """Queue a sync for the tenant (or return its pending one). Returns the job's status dict."""
+    with _lock:
+        job_id = _active.get(tenant_id)
+        if job_id is not None:
+            return _pending_jobs[job_id]
+        job_id = uuid.uuid4().hex
+        job = {"job_id": job_id, "tenant_id": tenant_id, "status": "queued", "result": None, "error": None}
+        _active[tenant_id] = job_id
+        _pending_jobs[job_id] = job
+    try:
+        _executor.submit(_run_sync, job_id, tenant_id, on_finish)
+    except Exception:
+        # e.g. the executor is shutting down — don't leave the tenant pointing at a job that never runs
+        with _lock:
+            _active.pop(tenant_id, None)
+            _pending_jobs.pop(job_id, None)
+        raise
+    return job
+
+
+def get_job(job_id: str) -> Optional[dict[str, Any]]:
+    """Return the job's status dict, or None if unknown or expired."""
+    with _lock:
+        job = _pending_jobs.get(job_id)
+    return job if job is not None else _finished_jobs.get(job_id)
+
+
+def shutdown_sync_workers() -> None:
+    """Drop queued syncs and wait for running ones to finish."""
+    _executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _run_sync(job_id: str, tenant_id: int, on_finish: Optional[Callable[[], None]]) -> None:
+    job = {"job_id": job_id, "tenant_id": tenant_id, "status": "running", "result": None, "error": None}
+    with _lock:
+        _pending_jobs[job_id] = job
+    try:
+        job = {**job, "status": "succeeded", "result": sync_tenant_task(tenant_id)}
+    except Exception as e:
+        logger.error("Sync failed for tenant %s: %s", tenant_id, e)
+        job = {**job, "status": "failed", "error": str(e)}
+    finally:
+        # The TTL starts now, when the job finishes, not when it was queued
+        _finished_jobs.set(job_id, job)
+        with _lock:
+            _pending_jobs.pop(job_id, None)
+            _active.pop(tenant_id, None)
+        if on_finish is not None:
+            on_finish()
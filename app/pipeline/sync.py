@@ -1,21 +1,43 @@
 """Sync accounting data into local DB."""
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
 from decimal import Decimal
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator
 
+from sqlalchemy import insert, lambda_stmt, select, update
 from sqlalchemy.orm import Session
 
 from app.connectors.quickbooks import (
     fetch_vendors,
-    fetch_bills,
+    iter_bills,
     fetch_bill_payments,
     parse_bill_line_items,
     refresh_tokens,
 )
+from app.database import SessionLocal
 from app.models import Tenant, Vendor, Bill, LineItem, Payment
 
 logger = logging.getLogger(__name__)
 
+# Rows per INSERT statement, so large pages don't build one huge statement (bounds memory and WAL)
+INSERT_BATCH_SIZE = 1000
+
+
+def _batched(rows: Iterable[dict], size: int) -> Iterator[list[dict]]:
+    """Yield rows in lists of at most size (itertools.batched needs Python 3.12)."""
+    it = iter(rows)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+@lru_cache(maxsize=512)
+def _parse_date(value: str) -> date:
+    """Parse a QBO YYYY-MM-DD date. Cached: bills in a sync cluster on a few dozen distinct dates."""
+    return date.fromisoformat(value)
+
 
 def sync_tenant(tenant: Tenant, db: Session) -> dict[str, int]:
     """Sync vendors, bills, payments for a tenant from QuickBooks."""
@@ -33,129 +55,227 @@ def sync_tenant(tenant: Tenant, db: Session) -> dict[str, int]:
         db.commit()
 
     counts = {"vendors": 0, "bills": 0, "payments": 0, "line_items": 0}
+    # One timestamp for the whole sync, so every bill it touches shares the same sync_at
+    sync_started = datetime.utcnow()
 
     logger.info("Starting sync for tenant %s", tenant.id)
 
-    # Sync vendors
-    qbo_vendors = fetch_vendors(tenant.access_token, tenant.accounting_realm_id)
-    vendor_map = {}  # qbo_id -> our Vendor
-    for v in qbo_vendors:
-        ext_id = str(v["Id"])
-        existing = db.query(Vendor).filter(
-            Vendor.tenant_id == tenant.id,
-            Vendor.external_id == ext_id,
-        ).first()
-        if existing:
-            existing.name = v.get("DisplayName") or v.get("CompanyName", "")
-            existing.display_name = v.get("DisplayName")
-            vendor_map[ext_id] = existing
-        else:
-            vendor = Vendor(
-                tenant_id=tenant.id,
-                external_id=ext_id,
-                name=v.get("DisplayName") or v.get("CompanyName", "Unknown"),
-                display_name=v.get("DisplayName"),
-            )
-            db.add(vendor)
-            db.flush()
-            vendor_map[ext_id] = vendor
-            counts["vendors"] += 1
-    db.commit()
-    # IDs are already assigned after flush+commit — no refresh needed
-
-    # Sync bills (last 90 days by default)
+    # The QBO queries are independent: vendors and payments download in the background
+    # while bills are streamed page by page below (bills/payments: last 90 days)
     end = date.today()
     start = end - timedelta(days=90)
-    qbo_bills = fetch_bills(tenant.access_token, tenant.accounting_realm_id, start.isoformat(), end.isoformat())
-    bill_map = {}
-    for b in qbo_bills:
-        ext_id = str(b["Id"])
-        vendor_ref = b.get("VendorRef", {})
-        vendor_ext_id = str(vendor_ref.get("value", ""))
-        vendor = vendor_map.get(vendor_ext_id)
-        if not vendor:
-            continue
-        txn_date_str = b.get("TxnDate", "")[:10]
-        txn_date = datetime.strptime(txn_date_str, "%Y-%m-%d").date() if txn_date_str else date.today()
-        total = float(b.get("TotalAmt", 0))
-        balance = float(b.get("Balance", 0))
-        existing = db.query(Bill).filter(
-            Bill.tenant_id == tenant.id,
-            Bill.external_id == ext_id,
-        ).first()
-        if existing:
-            existing.total_amount = total
-            existing.balance = balance
-            existing.txn_date = txn_date
-            existing.bill_number = b.get("DocNumber")
-            existing.due_date = datetime.strptime(b["DueDate"][:10], "%Y-%m-%d").date() if b.get("DueDate") else None
-            existing.sync_at = datetime.utcnow()
-            bill = existing
-        else:
-            bill = Bill(
-                tenant_id=tenant.id,
-                vendor_id=vendor.id,
-                external_id=ext_id,
-                bill_number=b.get("DocNumber"),
-                total_amount=total,
-                balance=balance,
-                due_date=datetime.strptime(b["DueDate"][:10], "%Y-%m-%d").date() if b.get("DueDate") else None,
-                txn_date=txn_date,
-            )
-            db.add(bill)
-            db.flush()
-            counts["bills"] += 1
-        bill_map[ext_id] = bill
-
-        # Line items
-        lines = parse_bill_line_items(b)
-        if lines:
-            # Clear and re-insert
-            db.query(LineItem).filter(LineItem.bill_id == bill.id).delete()
-            for line in lines:
-                li = LineItem(
-                    bill_id=bill.id,
-                    description=line.get("description"),
-                    amount=line["amount"],
-                    quantity=line.get("quantity", 1),
-                    unit_price=line.get("unit_price"),
-                )
-                db.add(li)
-                counts["line_items"] += 1
-            bill.has_line_items = True
+    token, realm_id = tenant.access_token, tenant.accounting_realm_id
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        vendors_future = pool.submit(fetch_vendors, token, realm_id)
+        payments_future = pool.submit(fetch_bill_payments, token, realm_id, start.isoformat(), end.isoformat())
+        vendor_ids = _sync_vendors(tenant.id, vendors_future.result(), counts, db)
+        db.commit()
 
-    db.commit()
+        # Sync bills, one QBO page at a time so only a page of bills and their ORM rows are held
+        bill_ids = {}  # qbo_id -> our Bill.id (plain ints, kept for payment linking)
+        missing_vendors: set[str] = set()  # vendor refs with no synced vendor; their bills are skipped
+        for qbo_bills in iter_bills(token, realm_id, start.isoformat(), end.isoformat()):
+            _sync_bill_page(tenant.id, qbo_bills, vendor_ids, bill_ids, missing_vendors, sync_started, counts, db)
+            # Send this page's writes; the identity map holds loaded bills weakly, so they're released
+            db.flush()
+        db.commit()
+        qbo_payments = payments_future.result()
 
     # Bill payments (link to bills via Line.LinkedTxn)
-    qbo_payments = fetch_bill_payments(tenant.access_token, tenant.accounting_realm_id, start.isoformat(), end.isoformat())
+    new_payments = {}  # our external_id -> (bill_id, amount, txn_date)
     for p in qbo_payments:
-        total_amt = float(p.get("TotalAmt", 0))
+        total_amt = p.get("TotalAmt", 0.0)
         txn_date_str = p.get("TxnDate", "")[:10]
-        txn_date = datetime.strptime(txn_date_str, "%Y-%m-%d").date() if txn_date_str else date.today()
+        txn_date = _parse_date(txn_date_str) if txn_date_str else date.today()
         for line in p.get("Line", []) or []:
             linked = line.get("LinkedTxn") or []
-            line_amt = float(line.get("Amount", total_amt))
+            line_amt = line.get("Amount", total_amt)
             for lt in linked:
                 if lt.get("TxnType") == "Bill":
-                    bill_ext_id = str(lt.get("TxnId", ""))
-                    bill = bill_map.get(bill_ext_id)
-                    if bill:
-                        amt = float(lt.get("Amount", line_amt))
-                        ext_id = f"bp-{p['Id']}-{bill.id}"
-                        existing = db.query(Payment).filter(Payment.external_id == ext_id).first()
-                        if not existing:
-                            pay = Payment(
-                                bill_id=bill.id,
-                                external_id=ext_id,
-                                total_amt=amt,
-                                txn_date=txn_date,
-                            )
-                            db.add(pay)
-                            counts["payments"] += 1
+                    bill_ext_id = lt.get("TxnId", "")
+                    bill_id = bill_ids.get(bill_ext_id)
+                    if bill_id:
+                        amt = lt.get("Amount", line_amt)
+                        ext_id = f"bp-{p['Id']}-{bill_id}"
+                        new_payments.setdefault(ext_id, (bill_id, amt, txn_date))
+    if new_payments:
+        # Already-synced payments are never updated; look them all up at once and skip them
+        synced = {
+            ext_id
+            for (ext_id,) in db.query(Payment.external_id).filter(
+                Payment.external_id.in_(list(new_payments))
+            )
+        }
+        payment_rows = [
+            {"bill_id": bill_id, "external_id": ext_id, "total_amt": amt, "txn_date": txn_date, "sync_at": sync_started}
+            for ext_id, (bill_id, amt, txn_date) in new_payments.items()
+            if ext_id not in synced
+        ]
+        if payment_rows:
+            # Only the diff is inserted, as one executemany rather than an ORM object per payment
+            for batch in _batched(payment_rows, INSERT_BATCH_SIZE):
+                db.execute(insert(Payment), batch)
+            counts["payments"] += len(payment_rows)
     db.commit()
 
+    if missing_vendors:
+        # e.g. bills from inactive vendors, which the QBO Vendor query doesn't return
+        logger.warning(
+            "Skipped bills for tenant %s referencing %d unknown vendors: %s",
+            tenant.id, len(missing_vendors), ", ".join(sorted(missing_vendors)[:20]),
+        )
     logger.info(
         "Sync complete for tenant %s: %d vendors, %d bills, %d payments, %d line_items",
         tenant.id, counts["vendors"], counts["bills"], counts["payments"], counts["line_items"],
     )
     return counts
+
+
+def _sync_vendors(tenant_id: int, qbo_vendors: list[dict], counts: dict[str, int], db: Session) -> dict[str, int]:
+    """Upsert QBO vendors; returns QBO vendor ID -> our Vendor.id."""
+    vendor_ids = {}  # qbo_id -> our Vendor.id
+    new_vendors = {}  # qbo_id -> row to insert
+    changed_vendors = []  # rows to update by primary key
+    ext_ids = [v["Id"] for v in qbo_vendors]
+    # Plain column tuples: the mapping rarely changes, so most vendors need no ORM object or write
+    existing_vendors = {
+        row.external_id: row
+        for row in db.query(Vendor.external_id, Vendor.id, Vendor.name, Vendor.display_name).filter(
+            Vendor.tenant_id == tenant_id,
+            Vendor.external_id.in_(ext_ids),
+        )
+    }
+    for ext_id, v in zip(ext_ids, qbo_vendors):
+        existing = existing_vendors.get(ext_id)
+        if existing:
+            name = v.get("DisplayName") or v.get("CompanyName", "")
+            display_name = v.get("DisplayName")
+            if (name, display_name) != (existing.name, existing.display_name):
+                changed_vendors.append({"id": existing.id, "name": name, "display_name": display_name})
+            vendor_ids[ext_id] = existing.id
+        else:
+            new_vendors[ext_id] = {
+                "tenant_id": tenant_id,
+                "external_id": ext_id,
+                "name": v.get("DisplayName") or v.get("CompanyName", "Unknown"),
+                "display_name": v.get("DisplayName"),
+            }
+    if new_vendors:
+        # One multi-row INSERT ... RETURNING hands back every new vendor's ID
+        inserted = db.execute(
+            insert(Vendor).returning(Vendor.id, Vendor.external_id),
+            list(new_vendors.values()),
+        )
+        vendor_ids.update({ext_id: vendor_id for vendor_id, ext_id in inserted})
+        counts["vendors"] += len(new_vendors)
+    if changed_vendors:
+        db.execute(update(Vendor), changed_vendors)
+    return vendor_ids
+
+
+def _sync_bill_page(
+    tenant_id: int,
+    qbo_bills: list[dict],
+    vendor_ids: dict[str, int],
+    bill_ids: dict[str, int],
+    missing_vendors: set[str],
+    sync_started: datetime,
+    counts: dict[str, int],
+    db: Session,
+) -> None:
+    """
+    Upsert one page of QBO bills and replace their line items. Records each bill's ID in bill_ids
+    and the refs of vendors it couldn't link in missing_vendors.
+    """
+    new_bills = {}  # qbo_id -> row to insert
+    bill_lines = {}  # qbo_id -> parsed lines; a bill repeated in the feed keeps its last lines
+    page_ext_ids = [b["Id"] for b in qbo_bills]
+    # Runs once per page: lambda_stmt reuses the built statement and its cache key, only the binds change
+    existing_bills = {
+        bill.external_id: bill
+        for bill in db.scalars(lambda_stmt(
+            lambda: select(Bill).where(Bill.tenant_id == tenant_id, Bill.external_id.in_(page_ext_ids))
+        ))
+    }
+    for b in qbo_bills:
+        ext_id = b["Id"]
+        vendor_ref = b.get("VendorRef", {})
+        vendor_ext_id = vendor_ref.get("value", "")
+        vendor_id = vendor_ids.get(vendor_ext_id)
+        if not vendor_id:
+            missing_vendors.add(vendor_ext_id)
+            continue
+        txn_date_str = b.get("TxnDate", "")[:10]
+        txn_date = _parse_date(txn_date_str) if txn_date_str else date.today()
+        total = b.get("TotalAmt", 0.0)
+        balance = b.get("Balance", 0.0)
+        lines = parse_bill_line_items(b)
+        existing = existing_bills.get(ext_id)
+        if existing:
+            existing.total_amount = total
+            existing.balance = balance
+            existing.txn_date = txn_date
+            existing.bill_number = b.get("DocNumber")
+            existing.due_date = _parse_date(b["DueDate"][:10]) if b.get("DueDate") else None
+            existing.sync_at = sync_started
+            if lines:
+                existing.has_line_items = True
+            bill_ids[ext_id] = existing.id
+        else:
+            new_bills[ext_id] = {
+                "tenant_id": tenant_id,
+                "vendor_id": vendor_id,
+                "external_id": ext_id,
+                "bill_number": b.get("DocNumber"),
+                "total_amount": total,
+                "balance": balance,
+                "due_date": _parse_date(b["DueDate"][:10]) if b.get("DueDate") else None,
+                "txn_date": txn_date,
+                "has_line_items": False,
+                "sync_at": sync_started,
+            }
+        # Line items — replaced in bulk once every bill has an ID
+        if lines:
+            bill_lines[ext_id] = lines
+
+    if new_bills:
+        for ext_id, row in new_bills.items():
+            row["has_line_items"] = ext_id in bill_lines
+        # One multi-row INSERT ... RETURNING hands back every new bill's ID
+        inserted = db.execute(
+            insert(Bill).returning(Bill.id, Bill.external_id),
+            list(new_bills.values()),
+        )
+        bill_ids.update({ext_id: bill_id for bill_id, ext_id in inserted})
+        counts["bills"] += len(new_bills)
+    if bill_lines:
+        # Clear and re-insert: one DELETE and one bulk INSERT for the page's bills
+        db.query(LineItem).filter(
+            LineItem.bill_id.in_([bill_ids[ext_id] for ext_id in bill_lines])
+        ).delete(synchronize_session=False)
+        line_rows = [
+            {
+                "bill_id": bill_ids[ext_id],
+                "description": line.get("description"),
+                "amount": line["amount"],
+                "quantity": line.get("quantity", 1),
+                "unit_price": line.get("unit_price"),
+            }
+            for ext_id, lines in bill_lines.items()
+            for line in lines
+        ]
+        for batch in _batched(line_rows, INSERT_BATCH_SIZE):
+            db.bulk_insert_mappings(LineItem, batch)
+        counts["line_items"] += len(line_rows)
+
+
+def sync_tenant_task(tenant_id: int) -> dict[str, int]:
+    """Run sync_tenant in its own session; entry point for background sync workers."""
+    db = SessionLocal()
+    try:
+        tenant = db.get(Tenant, tenant_id)
+        if tenant is None:
+            raise ValueError(f"Tenant {tenant_id} not found")
+        return sync_tenant(tenant, db)
+    finally:
+        db.close()
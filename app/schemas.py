@@ -20,6 +20,7 @@ MAX_LEN_NOTES = 2000
 MAX_LEN_DESCRIPTION = 2000
 MAX_LEN_OAUTH_CODE = 512
 MAX_LEN_STATE = 128
+MAX_LEN_CURSOR = 128
 
 
 class TenantCreate(BaseModel):
@@ -126,6 +127,15 @@ class SyncResult(BaseModel):
     line_items: int
 
 
+class SyncJob(BaseModel):
+    """Status of a background sync; result is set once it succeeds."""
+    job_id: str
+    tenant_id: int
+    status: Literal["queued", "running", "succeeded", "failed"]
+    result: Optional[SyncResult] = None
+    error: Optional[str] = None
+
+
 class DetectionResult(BaseModel):
     anomalies_found: int
 
@@ -48,9 +48,9 @@ def seed():
         else:
             vendors.append(v)
 
+    # IDs were assigned by flush/load; read them before commit expires the objects
+    vendor_ids = [v.id for v in vendors]
     db.commit()
-    for v in vendors:
-        db.refresh(v)
 
     # Create bills (duplicates, outliers, round numbers)
     base = date.today() - timedelta(days=90)
@@ -65,7 +65,6 @@ def seed():
         (1, 450, True), (1, 1100, True), (2, 999, False), (2, 5000, False),
     ]
     for i, (v_idx, amt, has_lines) in enumerate(bill_specs):
-        vendor = vendors[v_idx]
         txn = base + timedelta(days=20 + i * 3)  # Sequential, 3 days apart
         ext_id = f"bill-demo-{i+1}"
         existing = db.query(Bill).filter(Bill.tenant_id == t.id, Bill.external_id == ext_id).first()
@@ -73,7 +72,7 @@ def seed():
             continue
         b = Bill(
             tenant_id=t.id,
-            vendor_id=vendor.id,
+            vendor_id=vendor_ids[v_idx],
             external_id=ext_id,
             bill_number=f"INV-{1000+i}",
             total_amount=float(amt),